@@ -1,12 +1,36 @@
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import JSONResponse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 import numpy as np
 import cv2
+import asyncio
+import base64
+import hashlib
 import json
 import logging
 import os
+import threading
+import zlib
+
+try:
+    import faiss
+except ImportError:  # optional: fall back to Numba / NumPy matching
+    faiss = None
+
+try:
+    import orjson
+except ImportError:  # optional: fall back to the stdlib json parser
+    orjson = None
+
+try:
+    import numba
+except ImportError:  # optional: fall back to NumPy matching
+    numba = None
 
 # =========================
 # Logging configuration
@@ -17,13 +41,219 @@ logger = logging.getLogger(__name__)
 # =========================
 # Matching configuration
 # =========================
-# You can tweak this via env var on Render: MATCH_THRESHOLD=25
-MATCH_THRESHOLD = float(os.getenv("MATCH_THRESHOLD", "25.0"))
+# Side of the square face crop used as the encoding (ENCODING_SIZE^2 values).
+# 32x32 keeps 1024 dims instead of 10 000 for 100x100, which is ~10x less
+# matching work and upload size with no loss in this pixel-based matcher.
+ENCODING_SIZE = int(os.getenv("ENCODING_SIZE", "32"))
+# Length of an encoding vector
+ENCODING_DIM = ENCODING_SIZE * ENCODING_SIZE
+# Before the 32x32 change the threshold actually enforced was 15 (Spring's own
+# check on 100x100 INTER_LINEAR crops). 32x32 INTER_AREA distances measured
+# 0.16-0.32x the old ones (median ~0.26), so the defaults use a conservative
+# 0.23x: 15 -> 3.45 and the old confidence range 40 -> 9.2. Other sizes scale
+# linearly from that calibration; re-check thresholds when changing
+# ENCODING_SIZE or the resize interpolation.
+# You can tweak this via env var on Render: MATCH_THRESHOLD=3.45
+MATCH_THRESHOLD = float(os.getenv("MATCH_THRESHOLD", str(3.45 * ENCODING_SIZE / 32)))
 # Distance at which confidence ~ 0%
-CONFIDENCE_MAX_DISTANCE = float(os.getenv("CONFIDENCE_MAX_DISTANCE", "40.0"))
+CONFIDENCE_MAX_DISTANCE = float(
+    os.getenv("CONFIDENCE_MAX_DISTANCE", str(9.2 * ENCODING_SIZE / 32))
+)
+# Matching compares squared distances; the root is only taken for the response
+MATCH_THRESHOLD_SQ = MATCH_THRESHOLD ** 2
+# Number of distinct known-encoding sets kept parsed in memory
+ENCODINGS_CACHE_SIZE = int(os.getenv("ENCODINGS_CACHE_SIZE", "32"))
+# Known sets at least this large use an approximate HNSW index instead of exact search
+FAISS_HNSW_MIN_SIZE = int(os.getenv("FAISS_HNSW_MIN_SIZE", "10000"))
+# Numba matcher: known sets at least this large are scanned in parallel,
+# smaller ones serially with early exit
+NUMBA_PARALLEL_MIN_SIZE = int(os.getenv("NUMBA_PARALLEL_MIN_SIZE", "4096"))
+# Matching backend: "faiss", "numba", "numpy" or "auto" (first one installed)
+MATCHER = os.getenv("MATCHER", "auto").lower()
+
+_available_matchers = {"faiss": faiss is not None, "numba": numba is not None, "numpy": True}
+if MATCHER == "auto":
+    MATCHER = next(name for name, ok in _available_matchers.items() if ok)
+elif not _available_matchers.get(MATCHER, False):
+    raise RuntimeError(f"MATCHER={MATCHER} is unknown or its package is not installed")
+
+logger.info(f"Using ENCODING_SIZE={ENCODING_SIZE}, MATCH_THRESHOLD={MATCH_THRESHOLD}, "
+            f"CONFIDENCE_MAX_DISTANCE={CONFIDENCE_MAX_DISTANCE}, MATCHER={MATCHER}")
+
+# =========================
+# Detection configuration
+# =========================
+# Face detector: "haar" (default) or "yunet" (OpenCV DNN, needs YUNET_MODEL).
+# The encoding is the raw face crop, and YuNet and Haar frame faces differently,
+# so enrollments made under one detector do not match probes from the other:
+# re-register every student after switching.
+FACE_DETECTOR = os.getenv("FACE_DETECTOR", "haar").lower()
+YUNET_MODEL = os.getenv("YUNET_MODEL", "face_detection_yunet_2023mar.onnx")
+# Expected sha256 of YUNET_MODEL; the model is refused if it does not match
+YUNET_MODEL_SHA256 = os.getenv("YUNET_MODEL_SHA256", "").lower()
+YUNET_SCORE_THRESHOLD = float(os.getenv("YUNET_SCORE_THRESHOLD", "0.6"))
+# Images are downscaled so their long side is at most this before running the
+# detector; boxes are mapped back so the face is cropped at full resolution.
+DETECTION_MAX_SIZE = int(os.getenv("DETECTION_MAX_SIZE", "640"))
+# Smallest face (in original image pixels) the detector should report
+MIN_FACE_SIZE = 60
+# Uploads are decoded straight to grayscale; large ones at 1/2 or 1/4 size via
+# libjpeg's DCT scaling:
+# (minimum upload size in bytes, imdecode flag, reduction factor), largest first
+REDUCED_DECODE_STEPS = [
+    (2 * 1024 * 1024, cv2.IMREAD_REDUCED_GRAYSCALE_4, 4),
+    (512 * 1024, cv2.IMREAD_REDUCED_GRAYSCALE_2, 2),
+]
+# On /recognize-face, near-square uploads smaller than this on both sides are
+# treated as already cropped to the face and skip detection. Enrollment only
+# skips detection with an explicit X-Precropped: true header, so detection
+# still gates what gets registered.
+PRECROPPED_MAX_SIZE = int(os.getenv("PRECROPPED_MAX_SIZE", "200"))
+# OpenCV worker threads. Containers often report the host's CPU count, so set
+# this to the real CPU quota; use 1 when running several uvicorn workers.
+OPENCV_THREADS = int(os.getenv("OPENCV_THREADS", str(os.cpu_count() or 2)))
+cv2.setNumThreads(OPENCV_THREADS)
+logger.info(f"Using OPENCV_THREADS={OPENCV_THREADS}")
+
+# =========================
+# Numba matching kernels
+# =========================
+if MATCHER == "numba":
+    # Cached known matrices are read-only, so the signatures must say so
+    _known_matrix_type = numba.types.Array(numba.float32, 2, "C", readonly=True)
+
+    # Rows are abandoned as soon as their partial sum reaches the best distance
+    # so far; the check runs once per block so the inner loop still vectorizes
+    _EARLY_EXIT_BLOCK = 16
+
+    def _gen_argmin_kernels(dim):
+        """
+        Compile (argmin_l2, argmin_l2_early) for encodings of length dim.
+
+        dim is a closure constant, so Numba compiles it as a literal and can
+        unroll and vectorize the inner loops without runtime bounds. Kernels are
+        compiled eagerly from their signatures, so there is no first-request
+        warmup; they are not disk-cached since the cache would not key on dim.
+        """
+        @numba.njit(numba.int64(_known_matrix_type, numba.float32[::1]),
+                    fastmath=True, parallel=True)
+        def argmin_l2(known_matrix, unknown):
+            """Index of the row of known_matrix with the smallest squared L2 distance."""
+            count = known_matrix.shape[0]
+            dist_sq = np.empty(count, dtype=np.float32)
+            for i in numba.prange(count):
+                s = np.float32(0.0)
+                for j in range(dim):
+                    d = known_matrix[i, j] - unknown[j]
+                    s += d * d
+                dist_sq[i] = s
+            return dist_sq.argmin()
+
+        @numba.njit(numba.types.Tuple((numba.int64, numba.float32))(
+                        _known_matrix_type, numba.float32[::1]),
+                    fastmath=True)
+        def argmin_l2_early(known_matrix, unknown):
+            """(index, squared distance) of the closest row, pruning hopeless rows."""
+            count = known_matrix.shape[0]
+            best_index = 0
+            # fastmath assumes no infinities, so seed with the largest finite value
+            best = np.float32(np.finfo(np.float32).max)
+            for i in range(count):
+                s = np.float32(0.0)
+                for start in range(0, dim, _EARLY_EXIT_BLOCK):
+                    for j in range(start, min(start + _EARLY_EXIT_BLOCK, dim)):
+                        d = known_matrix[i, j] - unknown[j]
+                        s += d * d
+                    if s >= best:
+                        break
+                if s < best:
+                    best = s
+                    best_index = i
+            return best_index, best
+
+        return argmin_l2, argmin_l2_early
+
+    # Only valid for ENCODING_DIM-long encodings; /recognize-face rejects
+    # known sets of any other length before matching
+    argmin_l2, argmin_l2_early = _gen_argmin_kernels(ENCODING_DIM)
+
+
+# =========================
+# Request decompression
+# =========================
+# Largest request body accepted after gzip decompression, in bytes
+MAX_DECOMPRESSED_BODY = int(os.getenv("MAX_DECOMPRESSED_BODY", str(64 * 1024 * 1024)))
+
+
+class GzipRequestMiddleware:
+    """
+    ASGI middleware that transparently decompresses request bodies sent with
+    Content-Encoding: gzip (e.g. a large known_encodings_json form).
+    Bodies that inflate past MAX_DECOMPRESSED_BODY are rejected with 413 and
+    corrupt gzip data with 400.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = scope["headers"]
+        encoding = dict(headers).get(b"content-encoding", b"").lower()
+        if encoding != b"gzip":
+            await self.app(scope, receive, send)
+            return
+
+        # The body length changes, so drop both headers for the inner app
+        scope = dict(scope)
+        scope["headers"] = [
+            (name, value) for name, value in headers
+            if name not in (b"content-encoding", b"content-length")
+        ]
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        total = 0
+
+        async def receive_decompressed():
+            nonlocal total
+            message = await receive()
+            if message["type"] == "http.request":
+                remaining = MAX_DECOMPRESSED_BODY - total
+                try:
+                    # Never inflate more than one byte past the limit
+                    body = decompressor.decompress(message.get("body", b""), remaining + 1)
+                    if not message.get("more_body", False) and not decompressor.unconsumed_tail:
+                        body += decompressor.flush()
+                except zlib.error as e:
+                    raise HTTPException(status_code=400, detail=f"Invalid gzip body: {e}")
+                total += len(body)
+                if decompressor.unconsumed_tail or total > MAX_DECOMPRESSED_BODY:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"Decompressed body exceeds {MAX_DECOMPRESSED_BODY} bytes"
+                    )
+                message = {**message, "body": body}
+            return message
+
+        response_started = False
+
+        async def send_tracking(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive_decompressed, send_tracking)
+        except HTTPException as e:
+            # Raised from receive outside a route's own error handling
+            if response_started:
+                raise
+            response = JSONResponse(status_code=e.status_code, content={"detail": e.detail})
+            await response(scope, receive, send)
 
-logger.info(f"Using MATCH_THRESHOLD={MATCH_THRESHOLD}, "
-            f"CONFIDENCE_MAX_DISTANCE={CONFIDENCE_MAX_DISTANCE}")
 
 # =========================
 # FastAPI app
@@ -43,6 +273,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress large responses for clients that send Accept-Encoding: gzip, and
+# accept gzip-compressed request bodies
+app.add_middleware(GZipMiddleware, minimum_size=2048, compresslevel=5)
+app.add_middleware(GzipRequestMiddleware)
+
 # =========================
 # Load face cascade classifier
 # =========================
@@ -57,6 +292,358 @@ except Exception as e:
     logger.error(f"Error loading face cascade: {e}")
     raise
 
+# =========================
+# YuNet face detector
+# =========================
+def _check_yunet_model():
+    """Return None if YuNet can be used, else the reason it cannot."""
+    if not hasattr(cv2, "FaceDetectorYN"):
+        return "this OpenCV build has no FaceDetectorYN"
+    if not os.path.isfile(YUNET_MODEL):
+        return f"model file {YUNET_MODEL} not found"
+    if YUNET_MODEL_SHA256:
+        with open(YUNET_MODEL, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        if digest != YUNET_MODEL_SHA256:
+            return f"model file {YUNET_MODEL} has sha256 {digest}, expected {YUNET_MODEL_SHA256}"
+    return None
+
+
+# Set when YuNet was requested but could not be used; reported by /health
+detector_error = None
+USE_YUNET = False
+if FACE_DETECTOR == "yunet":
+    detector_error = _check_yunet_model()
+    if detector_error is None:
+        USE_YUNET = True
+        logger.info(f"Using YuNet face detector from {YUNET_MODEL}")
+    else:
+        detector_error = (f"FACE_DETECTOR=yunet requested but {detector_error}; "
+                          f"using Haar cascade, which will not match YuNet enrollments")
+        logger.error(detector_error)
+elif FACE_DETECTOR != "haar":
+    raise RuntimeError(f"FACE_DETECTOR={FACE_DETECTOR} is unknown, use 'haar' or 'yunet'")
+
+# FaceDetectorYN keeps its input size as state, so each thread gets its own
+_yunet_local = threading.local()
+
+
+def _get_yunet():
+    detector = getattr(_yunet_local, "detector", None)
+    if detector is None:
+        detector = cv2.FaceDetectorYN.create(
+            YUNET_MODEL, "", (320, 320), score_threshold=YUNET_SCORE_THRESHOLD
+        )
+        _yunet_local.detector = detector
+    return detector
+
+
+def _detect_yunet(gray, min_size):
+    """Run YuNet on a grayscale image and return (N, 4) boxes x, y, w, h."""
+    height, width = gray.shape[:2]
+    detector = _get_yunet()
+    detector.setInputSize((width, height))
+    # YuNet expects 3 channels; gray is already downscaled so this is cheap
+    _, faces = detector.detect(cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR))
+    if faces is None:
+        return np.empty((0, 4))
+
+    # Rows are [x, y, w, h, 5 landmarks (x, y), score]
+    boxes = faces[:, :4].astype(np.float64)
+    boxes[:, :2] = np.maximum(boxes[:, :2], 0.0)
+    keep = (boxes[:, 2] >= min_size) & (boxes[:, 3] >= min_size)
+    return boxes[keep]
+
+
+def reduced_decode_flag(size):
+    """Return (imdecode flag, reduction factor) to use for an upload of size bytes."""
+    for min_size, flag, reduction in REDUCED_DECODE_STEPS:
+        if size >= min_size:
+            return flag, reduction
+    return cv2.IMREAD_GRAYSCALE, 1
+
+
+def detect_face_boxes(gray, min_face_size=MIN_FACE_SIZE):
+    """
+    Detect faces on a downscaled copy of gray and return their boxes as an
+    (N, 4) array of x, y, w, h in gray's own coordinates. min_face_size is
+    in gray's pixels, so pass MIN_FACE_SIZE / reduction for reduced decodes.
+    """
+    height, width = gray.shape[:2]
+    scale = DETECTION_MAX_SIZE / max(height, width)
+    if scale < 1.0:
+        small = cv2.resize(
+            gray,
+            (max(1, int(width * scale)), max(1, int(height * scale))),
+            interpolation=cv2.INTER_AREA
+        )
+    else:
+        scale = 1.0
+        small = gray
+
+    min_size = max(1, int(min_face_size * scale))
+    if USE_YUNET:
+        boxes = _detect_yunet(small, min_size)
+    else:
+        faces = face_cascade.detectMultiScale(
+            small,
+            scaleFactor=1.1,
+            minNeighbors=5,
+            minSize=(min_size, min_size)
+        )
+        boxes = np.asarray(faces, dtype=np.float64).reshape(-1, 4)
+
+    return (boxes / scale).astype(np.int32)
+
+
+# =========================
+# Image processing (worker threads)
+# =========================
+# Decoding and detection are CPU-bound and OpenCV releases the GIL, so they run
+# in this pool instead of blocking the event loop.
+POOL_WORKERS = os.cpu_count() or 2
+_pool = ThreadPoolExecutor(max_workers=POOL_WORKERS)
+
+
+async def run_in_pool(func, *args):
+    """Run a blocking function in the worker pool and await its result."""
+    return await asyncio.get_running_loop().run_in_executor(_pool, func, *args)
+
+
+_resize_local = threading.local()
+
+
+def _get_resize_buffer():
+    """Per-thread (ENCODING_SIZE, ENCODING_SIZE) uint8 buffer for the face crop."""
+    buf = getattr(_resize_local, "buf", None)
+    if buf is None:
+        buf = _resize_local.buf = np.empty((ENCODING_SIZE, ENCODING_SIZE), np.uint8)
+    return buf
+
+
+def is_precropped(gray):
+    """True if the image is small and near-square, i.e. likely already a face crop."""
+    height, width = gray.shape[:2]
+    return max(height, width) < PRECROPPED_MAX_SIZE and 0.8 < height / width < 1.25
+
+
+def encode_largest_face(image_bytes, precropped=False, guess_precropped=False):
+    """
+    Decode an uploaded image, detect faces and encode the largest one.
+    With precropped, or with guess_precropped and an image that looks
+    precropped, the whole image is used as the face and detection is skipped.
+
+    Returns (encoding, faces). faces is None if the image could not be decoded;
+    if it is empty no face was found. encoding is None in both cases.
+    """
+    np_img = np.frombuffer(image_bytes, np.uint8)
+    decode_flag, reduction = reduced_decode_flag(len(image_bytes))
+    gray = cv2.imdecode(np_img, decode_flag)
+    if gray is None:
+        return None, None
+
+    # The size guess needs the original dimensions, so only full-size decodes
+    if precropped or (guess_precropped and reduction == 1 and is_precropped(gray)):
+        faces = np.array([[0, 0, gray.shape[1], gray.shape[0]]], dtype=np.int32)
+    else:
+        faces = detect_face_boxes(gray, MIN_FACE_SIZE / reduction)
+    if len(faces) == 0:
+        return None, faces
+
+    # Get the largest face
+    x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
+    logger.info(f"Face detected at position: x={x}, y={y}, w={w}, h={h}")
+
+    # Extract and resize face into this thread's reusable buffer, then
+    # normalise to a flattened float32 [0, 1] vector
+    face_roi = gray[y:y + h, x:x + w]
+    face_resized = _get_resize_buffer()
+    cv2.resize(
+        face_roi, (ENCODING_SIZE, ENCODING_SIZE), dst=face_resized,
+        interpolation=cv2.INTER_AREA
+    )
+    # Convert and scale in one pass straight into a new float32 array
+    encoding = np.multiply(
+        face_resized, np.float32(1.0 / 255.0), dtype=np.float32
+    ).ravel()
+    return encoding, faces
+
+
+def detect_all_faces(image_bytes):
+    """
+    Decode an uploaded image at full resolution and detect all faces.
+    Returns (gray.shape, faces), or (None, None) if it could not be decoded.
+    """
+    np_img = np.frombuffer(image_bytes, np.uint8)
+    gray = cv2.imdecode(np_img, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return None, None
+    return gray.shape, detect_face_boxes(gray)
+
+
+def _warm_up_worker(barrier):
+    # Per-thread detector and resize buffer, plus OpenCV's own thread pool
+    detect_face_boxes(np.zeros((240, 240), np.uint8))
+    _get_resize_buffer()
+    # Hold this thread until every worker has started, so each task lands on
+    # a different pool thread
+    barrier.wait(timeout=60)
+
+
+# Warm up every pool worker at startup so no request pays for creating the
+# detector (e.g. loading the YuNet model) or OpenCV's thread pool
+_warm_up_barrier = threading.Barrier(POOL_WORKERS)
+try:
+    for future in [_pool.submit(_warm_up_worker, _warm_up_barrier)
+                   for _ in range(POOL_WORKERS)]:
+        future.result()
+except threading.BrokenBarrierError:
+    logger.warning("Worker pool warmup timed out; some workers will warm up on first use")
+
+
+# =========================
+# Known encodings cache
+# =========================
+# The caller usually sends the same enrollment set on every request, so the
+# parsed matrix is kept keyed by a hash of the raw payload.
+_encodings_cache = OrderedDict()
+_encodings_cache_lock = threading.Lock()
+
+
+def _parse_json_encodings(raw):
+    """Parse a JSON array of encodings [[...], [...], ...] into a float32 matrix."""
+    # orjson is several times faster on large numeric arrays; its decode error
+    # subclasses json.JSONDecodeError so callers handle both the same way
+    known_encodings_raw = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    if not isinstance(known_encodings_raw, list) or len(known_encodings_raw) == 0:
+        raise ValueError("known_encodings_json must be a non-empty array")
+
+    known_matrix = np.ascontiguousarray(known_encodings_raw, dtype=np.float32)
+    if known_matrix.ndim != 2:
+        raise ValueError("All known encodings must have the same length")
+    return known_matrix
+
+
+def _parse_b64_encodings(raw, dtype):
+    """
+    Parse base64-packed encodings into a float32 matrix.
+
+    Layout (little-endian):
+    - float16: int32 count, then count * D float16 values
+    - int8:    int32 count, float32 scale, float32 zero_point, then count * D int8
+               values, dequantized as (q - zero_point) * scale
+    """
+    buf = base64.b64decode(raw, validate=True)
+    header_size = 4 if dtype == "float16" else 12
+    if len(buf) < header_size:
+        raise ValueError("known_encodings_b64 is too short")
+
+    count = int(np.frombuffer(buf, dtype="<i4", count=1)[0])
+    if count <= 0:
+        raise ValueError("known_encodings_b64 must contain at least one encoding")
+
+    if dtype == "float16":
+        values = np.frombuffer(buf, dtype="<f2", offset=header_size)
+    else:
+        scale, zero_point = np.frombuffer(buf, dtype="<f4", count=2, offset=4)
+        values = (np.frombuffer(buf, dtype=np.int8, offset=header_size)
+                  .astype(np.float32) - zero_point) * scale
+
+    if values.size == 0 or values.size % count != 0:
+        raise ValueError(
+            f"known_encodings_b64 holds {values.size} values, "
+            f"which is not a multiple of count={count}"
+        )
+    return np.ascontiguousarray(values.reshape(count, -1), dtype=np.float32)
+
+
+def _build_index(known_matrix):
+    """Build a FAISS index over the known encodings, or None for other matchers."""
+    if MATCHER != "faiss":
+        return None
+    count, dim = known_matrix.shape
+    if count >= FAISS_HNSW_MIN_SIZE:
+        index = faiss.IndexHNSWFlat(dim, 32)
+    else:
+        index = faiss.IndexFlatL2(dim)
+    index.add(known_matrix)
+    return index
+
+
+def _parse_encodings(raw, fmt):
+    """
+    Parse known encodings into a cache entry (known_matrix, known_sq, index):
+    a contiguous (N, D) float32 matrix, its per-row squared norms (NumPy
+    matcher only, else None) and a FAISS index (FAISS matcher only, else
+    None). Raises ValueError on malformed input.
+    """
+    if fmt == "json":
+        known_matrix = _parse_json_encodings(raw)
+    else:
+        known_matrix = _parse_b64_encodings(raw, fmt)
+
+    known_sq = None
+    if MATCHER == "numpy":
+        known_sq = np.einsum("ij,ij->i", known_matrix, known_matrix, dtype=np.float32)
+        known_sq.setflags(write=False)
+    index = _build_index(known_matrix)
+
+    # Entries are shared between requests
+    known_matrix.setflags(write=False)
+    return known_matrix, known_sq, index
+
+
+def load_known_encodings(raw, fmt="json"):
+    """
+    Return the (known_matrix, known_sq, index) entry for a payload, using the
+    LRU cache. fmt is "json", or the element type ("float16" / "int8") of a
+    base64 payload.
+    """
+    digest = hashlib.blake2b(raw.encode(), digest_size=16, person=fmt.encode()).digest()
+
+    with _encodings_cache_lock:
+        entry = _encodings_cache.get(digest)
+        if entry is not None:
+            _encodings_cache.move_to_end(digest)
+            return entry
+
+    entry = _parse_encodings(raw, fmt)
+
+    with _encodings_cache_lock:
+        _encodings_cache[digest] = entry
+        while len(_encodings_cache) > ENCODINGS_CACHE_SIZE:
+            _encodings_cache.popitem(last=False)
+    return entry
+
+
+def find_best_match(entry, unknown):
+    """
+    Return (best_index, best_distance_sq): the known encoding closest to
+    unknown and its squared Euclidean distance.
+    """
+    known_matrix, known_sq, index = entry
+
+    if index is not None:
+        dist_sq, indices = index.search(unknown.reshape(1, -1), 1)
+        return int(indices[0, 0]), max(float(dist_sq[0, 0]), 0.0)
+
+    if MATCHER == "numba":
+        if known_matrix.shape[0] < NUMBA_PARALLEL_MIN_SIZE:
+            best_index, best_sq = argmin_l2_early(known_matrix, unknown)
+            return int(best_index), float(best_sq)
+        best_index = int(argmin_l2(known_matrix, unknown))
+        diff = known_matrix[best_index] - unknown
+        return best_index, float(diff @ diff)
+
+    # ||k - u||^2 = k.k - 2 k.u + u.u: one GEMV per request, k.k comes from the
+    # cache entry, and the rest is done in place on the GEMV output
+    dist_sq = known_matrix @ unknown
+    dist_sq *= -2.0
+    dist_sq += known_sq
+    dist_sq += float(unknown @ unknown)
+    best_index = int(dist_sq.argmin())
+    return best_index, max(float(dist_sq[best_index]), 0.0)
+
 
 # =========================
 # Health / root endpoints
@@ -75,8 +662,11 @@ def root():
 def health_check():
     """Detailed health check."""
     return {
-        "status": "healthy",
+        "status": "degraded" if detector_error else "healthy",
         "cascade_loaded": not face_cascade.empty(),
+        "detector": "yunet" if USE_YUNET else "haar",
+        "detector_error": detector_error,
+        "matcher": MATCHER,
         "service": "face-recognition-api"
     }
 
@@ -85,35 +675,29 @@ def health_check():
 # /encode-face
 # =========================
 @app.post("/encode-face")
-async def encode_face(file: UploadFile = File(...)):
+async def encode_face(
+    file: UploadFile = File(...),
+    x_precropped: Optional[str] = Header(None)
+):
     """
     Encode a face from an uploaded image.
-    Returns a flattened vector representation of the face.
+    Send X-Precropped: true if the image is already cropped to the face.
+    Returns a flattened vector representation of the face as base64
+    little-endian float16 bytes (decode with np.frombuffer(..., dtype="<f2")).
     """
     try:
-        # Read and decode image
         image_bytes = await file.read()
-        np_img = np.frombuffer(image_bytes, np.uint8)
-        img = cv2.imdecode(np_img, cv2.IMREAD_COLOR)
+        encoding, faces = await run_in_pool(
+            encode_largest_face, image_bytes, (x_precropped or "").lower() == "true"
+        )
 
-        if img is None:
+        if faces is None:
             logger.error("Could not decode image")
             return {
                 "success": False,
                 "message": "Could not decode image. Please upload a valid image file."
             }
 
-        # Convert to grayscale
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-        # Detect faces
-        faces = face_cascade.detectMultiScale(
-            gray,
-            scaleFactor=1.1,
-            minNeighbors=5,
-            minSize=(60, 60)
-        )
-
         if len(faces) == 0:
             logger.warning("No face detected in image")
             return {
@@ -121,26 +705,17 @@ async def encode_face(file: UploadFile = File(...)):
                 "message": "No face detected. Please ensure your face is clearly visible in the image."
             }
 
-        # Get the largest face
-        x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
-        logger.info(f"Face detected at position: x={x}, y={y}, w={w}, h={h}")
-
-        # Extract and resize face
-        face_roi = gray[y:y + h, x:x + w]
-        face_resized = cv2.resize(face_roi, (100, 100))
-
-        # Create encoding (normalized flattened array)
-        encoding = face_resized.flatten().astype(float) / 255.0
-
         logger.info(f"Face encoded successfully. Vector length: {len(encoding)}")
 
         return {
             "success": True,
             "message": "Face encoded successfully",
-            "width": 100,
-            "height": 100,
+            "width": ENCODING_SIZE,
+            "height": ENCODING_SIZE,
             "vector_length": len(encoding),
-            "encoding": encoding.tolist(),
+            # Little-endian float16 bytes, base64 encoded (~7x smaller than a JSON list)
+            "encoding": base64.b64encode(encoding.astype("<f2").tobytes()).decode(),
+            "dtype": "float16",
             "faces_detected": len(faces)
         }
 
@@ -155,14 +730,21 @@ async def encode_face(file: UploadFile = File(...)):
 @app.post("/recognize-face")
 async def recognize_face(
     file: UploadFile = File(...),
-    known_encodings_json: str = Form(...)
+    known_encodings_json: Optional[str] = Form(None),
+    known_encodings_b64: Optional[str] = Form(None),
+    known_encodings_dtype: str = Form("float16"),
+    x_precropped: Optional[str] = Header(None)
 ):
     """
     Recognize a face by comparing it with known encodings.
 
     Parameters:
     - file: Image file containing a face
+    - known_encodings_b64: base64 packed encodings (preferred, see _parse_b64_encodings)
+    - known_encodings_dtype: element type of known_encodings_b64, "float16" or "int8"
     - known_encodings_json: JSON array of known face encodings [[...], [...], ...]
+      (fallback when known_encodings_b64 is not sent)
+    - X-Precropped header: "true" if the image is already cropped to the face
 
     Returns:
     - success: bool
@@ -175,21 +757,36 @@ async def recognize_face(
     try:
         # ---- Parse known encodings ----
         try:
-            known_encodings_raw = json.loads(known_encodings_json)
-            if not isinstance(known_encodings_raw, list) or len(known_encodings_raw) == 0:
+            if known_encodings_b64:
+                if known_encodings_dtype not in ("float16", "int8"):
+                    return {
+                        "success": False,
+                        "message": "known_encodings_dtype must be 'float16' or 'int8'"
+                    }
+                known = await run_in_pool(
+                    load_known_encodings, known_encodings_b64, known_encodings_dtype
+                )
+            elif known_encodings_json:
+                known = await run_in_pool(load_known_encodings, known_encodings_json)
+            else:
                 return {
                     "success": False,
-                    "message": "known_encodings_json must be a non-empty array"
+                    "message": "known_encodings_b64 or known_encodings_json is required"
                 }
-
-            known_encodings = [np.array(k, dtype=float) for k in known_encodings_raw]
-            logger.info(f"Loaded {len(known_encodings)} known encodings")
+            known_matrix = known[0]
+            logger.info(f"Loaded {known_matrix.shape[0]} known encodings")
         except json.JSONDecodeError as e:
             logger.error(f"Invalid JSON: {e}")
             return {
                 "success": False,
                 "message": f"Invalid JSON format: {str(e)}"
             }
+        except ValueError as e:
+            logger.error(f"Invalid encodings: {e}")
+            return {
+                "success": False,
+                "message": str(e)
+            }
         except Exception as e:
             logger.error(f"Error parsing encodings: {e}")
             return {
@@ -197,27 +794,26 @@ async def recognize_face(
                 "message": f"Error parsing encodings: {str(e)}"
             }
 
-        # ---- Read and decode image ----
+        if known_matrix.shape[1] != ENCODING_DIM:
+            return {
+                "success": False,
+                "message": f"Known encodings have length {known_matrix.shape[1]}, "
+                           f"expected {ENCODING_DIM}"
+            }
+
+        # ---- Read image, detect and encode the largest face ----
         image_bytes = await file.read()
-        np_img = np.frombuffer(image_bytes, np.uint8)
-        img = cv2.imdecode(np_img, cv2.IMREAD_COLOR)
+        unknown, faces = await run_in_pool(
+            encode_largest_face, image_bytes, (x_precropped or "").lower() == "true", True
+        )
 
-        if img is None:
+        if faces is None:
             logger.error("Could not decode image")
             return {
                 "success": False,
                 "message": "Could not decode image"
             }
 
-        # ---- Detect face ----
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        faces = face_cascade.detectMultiScale(
-            gray,
-            scaleFactor=1.1,
-            minNeighbors=5,
-            minSize=(60, 60)
-        )
-
         if len(faces) == 0:
             logger.warning("No face detected in image")
             return {
@@ -225,18 +821,11 @@ async def recognize_face(
                 "message": "No face detected"
             }
 
-        # Get the largest face and encode it
-        x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
-        face_roi = gray[y:y + h, x:x + w]
-        face_resized = cv2.resize(face_roi, (100, 100))
-        unknown = face_resized.flatten().astype(float) / 255.0
+        # ---- Find the closest known encoding (Euclidean distance) ----
+        best_index, best_distance_sq = find_best_match(known, unknown)
 
-        # ---- Compare with each known encoding (Euclidean distance) ----
-        distances = [float(np.linalg.norm(unknown - k)) for k in known_encodings]
-        best_index = int(np.argmin(distances))
-        best_distance = float(distances[best_index])
-
-        is_match = best_distance < MATCH_THRESHOLD
+        is_match = best_distance_sq < MATCH_THRESHOLD_SQ
+        best_distance = float(np.sqrt(best_distance_sq))
 
         # Confidence: 100% at distance 0, ~0% at CONFIDENCE_MAX_DISTANCE
         confidence = max(0.0, 100.0 * (1.0 - best_distance / CONFIDENCE_MAX_DISTANCE))
@@ -260,6 +849,15 @@ async def recognize_face(
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
 
 
+@app.get("/recognize-face")
+async def recognize_face_get():
+    """Explain that /recognize-face only accepts POST."""
+    return JSONResponse(
+        status_code=405,
+        content={"detail": "Use POST /recognize-face with an image and encodings."},
+    )
+
+
 # =========================
 # /detect-faces (debug)
 # =========================
@@ -271,23 +869,14 @@ async def detect_faces(file: UploadFile = File(...)):
     """
     try:
         image_bytes = await file.read()
-        np_img = np.frombuffer(image_bytes, np.uint8)
-        img = cv2.imdecode(np_img, cv2.IMREAD_COLOR)
+        image_shape, faces = await run_in_pool(detect_all_faces, image_bytes)
 
-        if img is None:
+        if image_shape is None:
             return {
                 "success": False,
                 "message": "Could not decode image"
             }
 
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        faces = face_cascade.detectMultiScale(
-            gray,
-            scaleFactor=1.1,
-            minNeighbors=5,
-            minSize=(60, 60)
-        )
-
         face_list = []
         for (x, y, w, h) in faces:
             face_list.append({
@@ -303,8 +892,8 @@ async def detect_faces(file: UploadFile = File(...)):
             "success": True,
             "faces_detected": len(faces),
             "faces": face_list,
-            "image_width": img.shape[1],
-            "image_height": img.shape[0]
+            "image_width": image_shape[1],
+            "image_height": image_shape[0]
         }
 
     except Exception as e:
@@ -325,9 +914,3 @@ if __name__ == "__main__":
         port=port,
         log_level="info"
     )
-@app.get("/recognize-face")
-async def recognize_face_get():
-    return JSONResponse(
-        status_code=405,
-        content={"detail": "Use POST /recognize-face with an image and encodings."},
-    )
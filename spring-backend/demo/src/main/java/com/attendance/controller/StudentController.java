@@ -14,9 +14,12 @@ import org.springframework.web.bind.annotation.*;
 import org.springframework.web.client.RestTemplate;
 import org.springframework.web.multipart.MultipartFile;
 
+import java.nio.ByteBuffer;
+import java.nio.ByteOrder;
 import java.time.LocalDate;
 import java.time.LocalTime;
 import java.util.ArrayList;
+import java.util.Base64;
 import java.util.List;
 import java.util.Optional;
 
@@ -33,6 +36,11 @@ public class StudentController {
     @Value("${python.api.url:http://localhost:8000}")
     private String pythonApiUrl;
 
+    // Upper bound on accepted distance, applied on top of the service's is_match.
+    // Default matches the old 15.0 on 100x100 encodings, recalibrated for 32x32.
+    @Value("${face.match.max-distance:3.45}")
+    private double maxMatchDistance;
+
     public StudentController(StudentRepository studentRepository,
                              AttendanceRepository attendanceRepository,
                              RestTemplate restTemplate) {
@@ -158,18 +166,69 @@ public class StudentController {
         }
     }
 
-    // 🔹 Helper: extract encoding array from JSON stored in DB
-    private double[] extractEncodingArray(String json) throws Exception {
+    // 🔹 Helper: extract encoding from JSON stored in DB as little-endian float16 bytes
+    private byte[] extractEncodingFloat16(String json) throws Exception {
         JsonNode root = objectMapper.readTree(json);
         JsonNode encNode = root.get("encoding");
+
+        // Current format: base64 float16 bytes, used as-is
+        if (encNode != null && encNode.isTextual()) {
+            JsonNode dtypeNode = root.get("dtype");
+            if (dtypeNode != null && !"float16".equals(dtypeNode.asText())) {
+                throw new Exception("Unsupported encoding dtype in database: " + dtypeNode.asText());
+            }
+            return Base64.getDecoder().decode(encNode.asText());
+        }
+
+        // Older format: JSON array of doubles
         if (encNode == null || !encNode.isArray()) {
             throw new Exception("Invalid encoding format in database");
         }
-        double[] arr = new double[encNode.size()];
+        ByteBuffer buf = ByteBuffer.allocate(encNode.size() * 2).order(ByteOrder.LITTLE_ENDIAN);
         for (int i = 0; i < encNode.size(); i++) {
-            arr[i] = encNode.get(i).asDouble();
+            buf.putShort(floatToHalf((float) encNode.get(i).asDouble()));
         }
-        return arr;
+        return buf.array();
+    }
+
+    // 🔹 Helper: convert a float to IEEE 754 half precision bits (round to nearest)
+    private static short floatToHalf(float value) {
+        int bits = Float.floatToIntBits(value);
+        int sign = (bits >>> 16) & 0x8000;
+        int abs = bits & 0x7fffffff;
+        int rounded = abs + 0x1000;
+
+        if (rounded >= 0x47800000) {
+            if (abs >= 0x7f800000) {
+                // Inf or NaN
+                return (short) (sign | 0x7c00 | ((abs & 0x007fffff) >>> 13));
+            }
+            // Too large for half precision
+            return (short) (sign | 0x7c00);
+        }
+        if (rounded >= 0x38800000) {
+            // Normalized half
+            return (short) (sign | ((rounded - 0x38000000) >>> 13));
+        }
+        if (abs < 0x33000000) {
+            // Too small, flush to zero
+            return (short) sign;
+        }
+        // Subnormal half
+        int exponent = abs >>> 23;
+        int mantissa = (abs & 0x7fffff) | 0x800000;
+        return (short) (sign | ((mantissa + (0x800000 >>> (exponent - 102))) >>> (126 - exponent)));
+    }
+
+    // 🔹 Helper: pack encodings as base64 [int32 count][count * D float16], little-endian
+    private String packEncodingsFloat16(List<byte[]> encList) {
+        ByteBuffer buf = ByteBuffer.allocate(4 + encList.size() * encList.get(0).length)
+                .order(ByteOrder.LITTLE_ENDIAN);
+        buf.putInt(encList.size());
+        for (byte[] enc : encList) {
+            buf.put(enc);
+        }
+        return Base64.getEncoder().encodeToString(buf.array());
     }
 
     // 🔹 Mark attendance using face recognition
@@ -188,12 +247,12 @@ public class StudentController {
                         .body("No students registered. Please register students first.");
             }
 
-            // Build list of encodings [[...], [...], ...]
-            List<double[]> encList = new ArrayList<>();
+            // Build list of float16 encodings
+            List<byte[]> encList = new ArrayList<>();
             for (Student s : students) {
                 try {
-                    double[] arr = extractEncodingArray(s.getFaceEncoding());
-                    encList.add(arr);
+                    byte[] enc = extractEncodingFloat16(s.getFaceEncoding());
+                    encList.add(enc);
                 } catch (Exception e) {
                     System.err.println("Error extracting encoding for student " + s.getName() + ": " + e.getMessage());
                 }
@@ -204,7 +263,16 @@ public class StudentController {
                         .body("No valid face encodings found in database");
             }
 
-            String encJson = objectMapper.writeValueAsString(encList);
+            // All encodings must share one length to be packed into a single matrix
+            int dim = encList.get(0).length;
+            for (byte[] enc : encList) {
+                if (enc.length != dim) {
+                    return ResponseEntity.badRequest()
+                            .body("Stored face encodings have inconsistent lengths. Please re-register students.");
+                }
+            }
+
+            String encB64 = packEncodingsFloat16(encList);
 
             String url = pythonApiUrl + "/recognize-face";
             System.out.println("Calling Python API for recognition at: " + url);
@@ -214,7 +282,8 @@ public class StudentController {
 
             MultiValueMap<String, Object> body = new LinkedMultiValueMap<>();
             body.add("file", faceImage.getResource());
-            body.add("known_encodings_json", encJson);
+            body.add("known_encodings_b64", encB64);
+            body.add("known_encodings_dtype", "float16");
 
             HttpEntity<MultiValueMap<String, Object>> requestEntity =
                     new HttpEntity<>(body, headers);
@@ -237,10 +306,11 @@ public class StudentController {
             int bestIndex = root.get("best_index").asInt();
             double distance = root.get("distance").asDouble();
 
-            // Threshold – tune this based on your images
-            double threshold = 15.0;  // Adjust based on testing
+            // Both the service's MATCH_THRESHOLD and our own bound must accept the
+            // match, so a loose service config cannot widen acceptance on its own
+            double threshold = Math.min(root.get("threshold").asDouble(), maxMatchDistance);
 
-            if (distance > threshold) {
+            if (!root.get("is_match").asBoolean() || distance > threshold) {
                 return ResponseEntity.badRequest()
                         .body("Face not recognized. Distance: " + String.format("%.2f", distance) + 
                               " (threshold: " + threshold + "). Please try again or register first.");